@@ -11,68 +11,164 @@ import os
 
 try:
     import mlx.core as mx
-    from mlx_lm import load, generate
+    from mlx_lm.generate import generate_step
+    from mlx_lm.models.cache import make_prompt_cache, trim_prompt_cache
+    from model_server import ModelServer, positive_int
+    from sampling import make_top_k_sampler
 except ImportError as e:
     print(f"Error: Missing required dependencies. Please install with: pip install -r requirements.txt")
     print(f"Import error: {e}")
     sys.exit(1)
 
+STOP_STRINGS = ["<|im_end|>", "<|im_start|>"]
+
 class LLaMAChat:
-    def __init__(self, model_path: str = None, max_tokens: int = 512, temperature: float = 0.7):
+    def __init__(self, model_path: str = None, max_tokens: int = 512, temperature: float = 0.7,
+                 history_budget: int = 1024):
         self.max_tokens = max_tokens
         self.temperature = temperature
+        self.history_budget = history_budget
         self.conversation_history = []
+        self.history_token_ids = []
+        # First history message included in prompts (see format_prompt)
+        self.history_start = 0
         
         print("Loading LLaMA-2-13B model...")
-        self.model, self.tokenizer = load(model_path or "TheBloke/Llama-2-13B-chat-AWQ")
+        # ModelServer warms the model and Metal cache once for the whole session
+        self.server = ModelServer(model_path)
+        self.model, self.tokenizer = self.server.model, self.server.tokenizer
+        self.sampler = make_top_k_sampler(temp=temperature, top_p=0.9, top_k=40)
+        
+        # Encoded once: the assistant header ends every prompt, and the latest
+        # user message is reused when it is added to history
+        self.assistant_header_ids = self.tokenizer.encode("<|im_start|>assistant\n", add_special_tokens=False)
+        self.pending_user_message = None
+        
+        # One KV cache for the whole session; cache_tokens tracks what it holds
+        self.reset_cache()
         print("Model loaded! Ready to chat.")
         print("Type 'quit', 'exit', or 'bye' to end the conversation.")
         print("Type 'clear' to clear conversation history.")
         print("Type 'help' for available commands.")
         print("-" * 60)
     
+    def encode_message(self, role: str, content: str) -> list:
+        """Tokenize one chat-formatted message, without the BOS token."""
+        return self.tokenizer.encode(f"<|im_start|>{role}\n{content}<|im_end|>\n", add_special_tokens=False)
+    
     def add_to_history(self, role: str, content: str):
         """Add a message to conversation history."""
         self.conversation_history.append({"role": role, "content": content})
+        
+        if role == "user" and self.pending_user_message and self.pending_user_message[0] == content:
+            message_ids = self.pending_user_message[1]
+        else:
+            message_ids = self.encode_message(role, content)
+        self.history_token_ids.append(message_ids)
     
     def clear_history(self):
         """Clear conversation history."""
         self.conversation_history.clear()
+        self.history_token_ids.clear()
+        self.history_start = 0
+        self.reset_cache()
         print("Conversation history cleared.")
     
-    def format_prompt(self, user_input: str) -> str:
-        """Format the user input with conversation history for better context."""
-        if not self.conversation_history:
-            return f"<|im_start|>user\n{user_input}<|im_end|>\n<|im_start|>assistant\n"
+    def format_prompt(self, user_input: str) -> list:
+        """Build the prompt token ids from the user input and recent history.
         
-        # Build context from recent history (last 4 exchanges to avoid token limit)
-        recent_history = self.conversation_history[-8:]  # Last 4 exchanges
+        History runs from history_start to the latest message. Once it exceeds
+        history_budget tokens, the oldest messages are dropped until it fits in
+        half the budget. The prompt prefix then stays the same for the next few
+        turns, so the session cache still covers it and only new messages are
+        prefilled. Messages are tokenized once when added to history.
+        """
+        user_ids = self.encode_message("user", user_input)
+        self.pending_user_message = (user_input, user_ids)
+        prompt_ids = user_ids + self.assistant_header_ids
         
-        formatted_prompt = ""
-        for msg in recent_history:
-            if msg["role"] == "user":
-                formatted_prompt += f"<|im_start|>user\n{msg['content']}<|im_end|>\n"
-            else:
-                formatted_prompt += f"<|im_start|>assistant\n{msg['content']}<|im_end|>\n"
+        used = sum(len(message_ids) for message_ids in self.history_token_ids[self.history_start:])
+        if used > self.history_budget:
+            while used > self.history_budget // 2:
+                used -= len(self.history_token_ids[self.history_start])
+                self.history_start += 1
+        
+        history_ids = [token for message_ids in self.history_token_ids[self.history_start:] for token in message_ids]
+        
+        bos = [self.tokenizer.bos_token_id] if self.tokenizer.bos_token_id is not None else []
+        return bos + history_ids + prompt_ids
+    
+    def reset_cache(self):
+        """Start a fresh KV cache for the session."""
+        self.prompt_cache = make_prompt_cache(self.model)
+        self.cache_tokens = []
+    
+    def reuse_cache(self, prompt_ids: list) -> int:
+        """Trim the session KV cache to its longest shared prefix with the prompt.
+        
+        Returns the number of prompt tokens already in the cache, which don't need
+        to be prefilled again.
+        """
+        common = 0
+        for cached, new in zip(self.cache_tokens, prompt_ids):
+            if cached != new:
+                break
+            common += 1
         
-        formatted_prompt += f"<|im_start|>user\n{user_input}<|im_end|>\n<|im_start|>assistant\n"
-        return formatted_prompt
+        # Always leave at least one token to feed so the model produces logits
+        common = min(common, len(prompt_ids) - 1)
+        trim_prompt_cache(self.prompt_cache, len(self.cache_tokens) - common)
+        self.cache_tokens = prompt_ids[:common]
+        return common
     
     def generate_response(self, user_input: str) -> str:
         """Generate a response from the model."""
         try:
-            formatted_prompt = self.format_prompt(user_input)
+            prompt_ids = self.format_prompt(user_input)
+            cached = self.reuse_cache(prompt_ids)
             
             start_time = time.time()
-            response = generate(
+            token_ids = []
+            # Decoded text length after each reply token, to count the tokens before a stop string
+            text_lengths = []
+            detokenizer = self.tokenizer.detokenizer
+            detokenizer.reset()
+            
+            # Hold back enough text that a partial stop string is never printed
+            printed = 0
+            hold_back = max(len(stop) for stop in STOP_STRINGS) - 1
+            
+            for token, _ in generate_step(
+                mx.array(prompt_ids[cached:]),
                 self.model,
-                self.tokenizer,
-                formatted_prompt,
                 max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                top_p=0.9,
-                stop=["<|im_end|>", "<|im_start|>"]
-            )
+                sampler=self.sampler,
+                prompt_cache=self.prompt_cache
+            ):
+                token_ids.append(token)
+                if token in self.tokenizer.eos_token_ids:
+                    break
+                detokenizer.add_token(token)
+                text = detokenizer.text
+                text_lengths.append(len(text))
+                if any(stop in text for stop in STOP_STRINGS):
+                    break
+                
+                # Stream text as it is decoded so the reply appears at first-token latency
+                if len(text) - hold_back > printed:
+                    print(text[printed:len(text) - hold_back], end="", flush=True)
+                    printed = len(text) - hold_back
+            
+            # Every yielded token has been fed through the model, so it is in the cache
+            self.cache_tokens = prompt_ids + token_ids
+            
+            detokenizer.finalize()
+            response = detokenizer.text
+            for stop in STOP_STRINGS:
+                response = response.split(stop)[0]
+            print(response[printed:], flush=True)
+            # EOS and stop-string tokens are in the cache but not in the reply
+            tokens_generated = sum(1 for length in text_lengths if length <= len(response))
             
             # Clean up the response
             response = response.strip()
@@ -80,7 +176,6 @@ class LLaMAChat:
                 response = response[10:].strip()
             
             generation_time = time.time() - start_time
-            tokens_generated = len(self.tokenizer.encode(response))
             
             print(f"Generated {tokens_generated} tokens in {generation_time:.2f}s")
             
@@ -88,7 +183,10 @@ class LLaMAChat:
             
         except Exception as e:
             print(f"Error generating response: {e}")
-            return "I apologize, but I encountered an error while generating a response. Please try again."
+            self.reset_cache()
+            response = "I apologize, but I encountered an error while generating a response. Please try again."
+            print(response)
+            return response
     
     def chat(self):
         """Main chat loop."""
@@ -118,15 +216,12 @@ class LLaMAChat:
                     self.show_stats()
                     continue
                 
-                # Add user input to history
-                self.add_to_history("user", user_input)
-                
-                # Generate and display response
+                # Generate and stream the response
                 print("\nLLaMA-2-13B: ", end="", flush=True)
                 response = self.generate_response(user_input)
-                print(response)
                 
-                # Add response to history
+                # Add the exchange to history (the prompt already included the user input)
+                self.add_to_history("user", user_input)
                 self.add_to_history("assistant", response)
                 
             except KeyboardInterrupt:
@@ -170,20 +265,23 @@ class LLaMAChat:
         print(f"  Assistant messages: {assistant_messages}")
         print(f"  Model: LLaMA-2-13B (4-bit quantized)")
         print(f"  Max tokens: {self.max_tokens}")
+        print(f"  History budget: {self.history_budget} tokens")
         print(f"  Temperature: {self.temperature}")
 
 def main():
     parser = argparse.ArgumentParser(description="Interactive Chat with LLaMA-2-13B")
     parser.add_argument("--model", type=str, 
-                       help="Custom model path (default: TheBloke/Llama-2-13B-chat-AWQ)")
-    parser.add_argument("--max-tokens", type=int, default=512, 
+                       help="Custom model path (default: models/Llama-2-13b-chat-mlx-q4)")
+    parser.add_argument("--max-tokens", type=positive_int, default=512, 
                        help="Maximum number of tokens to generate")
     parser.add_argument("--temperature", type=float, default=0.7, 
                        help="Sampling temperature (0.0 = deterministic, 1.0 = random)")
+    parser.add_argument("--history-tokens", type=int, default=1024, 
+                       help="Maximum number of conversation history tokens included in each prompt")
     
     args = parser.parse_args()
     
-            print("MLX LLaMA-2-13B Interactive Chat")
+    print("MLX LLaMA-2-13B Interactive Chat")
     print("=" * 60)
     
     # Check MLX version
@@ -192,7 +290,7 @@ def main():
     print()
     
     # Start the chat
-    chat = LLaMAChat(args.model, args.max_tokens, args.temperature)
+    chat = LLaMAChat(args.model, args.max_tokens, args.temperature, args.history_tokens)
     chat.chat()
 
 if __name__ == "__main__":
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Persistent Model Server for LLaMA-2-13B using MLX
+Keeps the model resident in unified memory so clients skip the load cost.
+"""
+
+import argparse
+import ipaddress
+import os
+import secrets
+import socket
+import time
+import sys
+from pathlib import Path
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+try:
+    import mlx.core as mx
+    from mlx_lm import load
+    from mlx_lm.generate import generate_step
+    from sampling import make_top_k_sampler
+except ImportError as e:
+    print(f"Error: Missing required dependencies")
+    print(f"Import error: {e}")
+    sys.exit(1)
+
+# Resolved against this directory so the scripts work from any working directory
+MODELS_DIR = Path(__file__).resolve().parent / "models"
+DEFAULT_MODEL = str(MODELS_DIR / "Llama-2-13b-chat-mlx-q4")
+AWQ_MODEL = str(MODELS_DIR / "Llama-2-13b-chat-mlx-awq")
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 6000
+# Requests are pickled, so only clients holding this server's key may connect.
+# A fresh key is written here (owner-only) on every start, or taken from the
+# environment when client and server share one.
+AUTHKEY_ENV = "MLX_SERVER_AUTHKEY"
+AUTHKEY_DIR = Path.home() / ".cache" / "mlx-llama2-13b"
+
+def authkey_file(port: int) -> Path:
+    """Where the server running on port publishes its authkey."""
+    return AUTHKEY_DIR / f"server-{port}.key"
+
+def create_authkey(port: int) -> bytes:
+    """Generate this server start's authkey and share it through a 0600 key file."""
+    if AUTHKEY_ENV in os.environ:
+        return bytes.fromhex(os.environ[AUTHKEY_ENV])
+
+    authkey = secrets.token_bytes(32)
+    AUTHKEY_DIR.mkdir(parents=True, exist_ok=True, mode=0o700)
+    key_file = authkey_file(port)
+    key_file.unlink(missing_ok=True)
+
+    # O_EXCL so the key is never written into a file someone else pre-created
+    fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(authkey.hex())
+    return authkey
+
+def read_authkey(port: int) -> bytes:
+    """Load the authkey of the server running on port."""
+    if AUTHKEY_ENV in os.environ:
+        return bytes.fromhex(os.environ[AUTHKEY_ENV])
+    return bytes.fromhex(authkey_file(port).read_text().strip())
+
+def positive_int(value: str) -> int:
+    """argparse type for counts that must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+def is_loopback(host: str) -> bool:
+    """Check whether host only accepts connections from this machine."""
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (socket.gaierror, ValueError):
+        return False
+
+def resolve_model_path(model_path: str = None) -> str:
+    """Pick the model to load, preferring pre-calibrated weights from prepare_awq.py."""
+    if model_path is not None:
+        return model_path
+    if Path(AWQ_MODEL).exists():
+        return AWQ_MODEL
+    if Path(DEFAULT_MODEL).exists():
+        return DEFAULT_MODEL
+
+    # Otherwise load() would treat the path as a Hugging Face repo id and fail with a 404
+    print(f"Error: no converted model found at {DEFAULT_MODEL}")
+    print("Run ./setup.sh, or convert it yourself with:")
+    print("  python -m mlx_lm convert --hf-path meta-llama/Llama-2-13b-chat-hf \\")
+    print(f"      --mlx-path {DEFAULT_MODEL} -q --q-bits 4 --q-group-size 64")
+    sys.exit(1)
+
+class ModelServer:
+    def __init__(self, model_path: str = None, cache_limit_gb: int = 8):
+        self.model_path = resolve_model_path(model_path)
+
+        print(f"Loading model: {self.model_path}")
+        load_start = time.time()
+
+        self.model, self.tokenizer = load(self.model_path)
+
+        # Materialize the embedding table now so the first request doesn't pay for it
+        mx.eval(self.model.model.embed_tokens.parameters())
+
+        # Keep freed Metal buffers cached so later requests reuse them
+        mx.set_cache_limit(cache_limit_gb * 1024**3)
+
+        print(f"Model loaded in {time.time() - load_start:.2f}s")
+
+    def generate_tokens(self, prompt: str, max_tokens: int = 512, temperature: float = 0.7) -> list:
+        """Generate completion token ids (prompt excluded) with the resident model."""
+        sampler = make_top_k_sampler(temp=temperature, top_p=0.9, top_k=40)
+        prompt_ids = mx.array(self.tokenizer.encode(prompt))
+
+        token_ids = []
+        for token, _ in generate_step(prompt_ids, self.model, max_tokens=max_tokens, sampler=sampler):
+            if token in self.tokenizer.eos_token_ids:
+                break
+            token_ids.append(token)
+
+        return token_ids
+
+    def generate(self, prompt: str, max_tokens: int = 512, temperature: float = 0.7) -> str:
+        """Generate a response with the resident model."""
+        return self.tokenizer.decode(self.generate_tokens(prompt, max_tokens, temperature))
+
+    def handle(self, conn):
+        """Serve (prompt, max_tokens, temperature) requests until the client disconnects.
+
+        Each reply is (response, tokens_generated), so clients can report speed
+        without a tokenizer of their own.
+        """
+        while True:
+            try:
+                prompt, max_tokens, temperature = conn.recv()
+                if not isinstance(prompt, str) or type(max_tokens) is not int \
+                        or not isinstance(temperature, (int, float)):
+                    raise TypeError("expected (str, int, float)")
+                # generate_step treats a negative limit as unlimited
+                if max_tokens < 1:
+                    raise ValueError(f"max_tokens must be at least 1, got {max_tokens}")
+            except (EOFError, OSError):
+                return
+            except Exception as e:
+                # Undecodable or malformed request; drop this client only
+                print(f"Bad request, closing connection: {e!r}")
+                return
+
+            try:
+                token_ids = self.generate_tokens(prompt, max_tokens, temperature)
+                reply = (self.tokenizer.decode(token_ids), len(token_ids))
+            except Exception as e:
+                print(f"Error during generation: {e}")
+                reply = (None, 0)
+
+            try:
+                conn.send(reply)
+            except OSError:
+                return
+
+    def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        """Block forever, answering generation requests from clients."""
+        authkey = create_authkey(port)
+        try:
+            with Listener((host, port), authkey=authkey) as listener:
+                print(f"Model server listening on {host}:{port}")
+                if AUTHKEY_ENV not in os.environ:
+                    print(f"Clients authenticate with the key in {authkey_file(port)}")
+                print("Press Ctrl+C to stop.")
+                while True:
+                    try:
+                        conn = listener.accept()
+                    except (AuthenticationError, EOFError, OSError) as e:
+                        print(f"Rejected connection: {e!r}")
+                        continue
+                    with conn:
+                        self.handle(conn)
+        finally:
+            if AUTHKEY_ENV not in os.environ:
+                authkey_file(port).unlink(missing_ok=True)
+
+def request_generation(prompt: str, max_tokens: int = 512, temperature: float = 0.7,
+                       host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> tuple:
+    """Send a single generation request to a running model server.
+
+    Returns (response, tokens_generated); response is None if generation failed.
+    Raises FileNotFoundError if no server has published a key for this port.
+    """
+    with Client((host, port), authkey=read_authkey(port)) as conn:
+        conn.send((prompt, max_tokens, temperature))
+        return conn.recv()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve LLaMA-2-13B from a persistent MLX process")
+    parser.add_argument("--model", type=str,
+                       help=f"Custom model path (default: {DEFAULT_MODEL})")
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST,
+                       help="Address to listen on")
+    parser.add_argument("--allow-remote", action="store_true",
+                       help="Allow listening on a non-loopback address")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                       help="Port to listen on")
+    parser.add_argument("--cache-limit", type=int, default=8,
+                       help="Metal buffer cache limit in GB")
+
+    args = parser.parse_args()
+
+    if not is_loopback(args.host):
+        if not args.allow_remote:
+            parser.error(f"refusing to listen on non-loopback host {args.host!r}; "
+                         "pass --allow-remote to override")
+        print("WARNING: listening beyond localhost. Requests are unpickled, so anyone")
+        print("holding the authkey can run arbitrary code as this user.")
+
+    print("MLX LLaMA-2-13B Model Server")
+    print("=" * 50)
+
+    server = ModelServer(args.model, args.cache_limit)
+
+    try:
+        server.serve(args.host, args.port)
+    except KeyboardInterrupt:
+        print("\n\nModel server stopped")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+AWQ Calibration for LLaMA-2-13B using MLX
+Runs the AWQ scale/clip search once and saves fused 4-bit weights, so loading
+the model later never repeats the calibration.
+"""
+
+import argparse
+import time
+import sys
+
+try:
+    import mlx.core as mx
+    from mlx_lm.quant.awq import AWQ_MODEL_CONFIGS, awq_quantize, update_config
+    from mlx_lm.quant.utils import load_data
+    from mlx_lm.utils import load, save
+    from model_server import AWQ_MODEL
+except ImportError as e:
+    print(f"Error: Missing required dependencies")
+    print(f"Import error: {e}")
+    sys.exit(1)
+
+DEFAULT_SOURCE = "meta-llama/Llama-2-13b-chat-hf"
+
+def prepare_awq(source: str = DEFAULT_SOURCE, output: str = AWQ_MODEL,
+                n_grid: int = 20, num_samples: int = 256, sequence_length: int = 512):
+    """Calibrate AWQ scales/clips on the full-precision model and save the quantized result."""
+    print(f"Loading full-precision model: {source}")
+    model, tokenizer, config = load(source, lazy=True, return_config=True)
+
+    awq_config = AWQ_MODEL_CONFIGS.get(config["model_type"])
+    if awq_config is None:
+        print(f"Error: AWQ is not supported for {config['model_type']} models")
+        sys.exit(1)
+
+    print(f"Calibrating with {num_samples} samples (n_grid={n_grid})...")
+    print("This can take a long time, but only needs to run once.")
+    start_time = time.time()
+
+    mx.random.seed(123)
+    calibration_data = load_data(tokenizer, num_samples, sequence_length)
+    awq_quantize(model, calibration_data, awq_config, bits=4, group_size=64, n_grid=n_grid)
+
+    print(f"Calibration completed in {time.time() - start_time:.2f}s")
+
+    save(output, source, model, tokenizer, update_config(model, config))
+    print(f"Saved AWQ-quantized model to: {output}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate and cache AWQ weights for LLaMA-2-13B")
+    parser.add_argument("--model", type=str, default=DEFAULT_SOURCE,
+                       help="Full-precision source model")
+    parser.add_argument("--output", type=str, default=AWQ_MODEL,
+                       help="Where to save the quantized model (picked up automatically by the other scripts)")
+    parser.add_argument("--n-grid", type=int, default=20,
+                       help="Grid size for the AWQ scale search")
+    parser.add_argument("--num-samples", type=int, default=256,
+                       help="Number of calibration samples")
+
+    args = parser.parse_args()
+
+    print("MLX LLaMA-2-13B AWQ Preparation")
+    print("=" * 50)
+
+    prepare_awq(args.model, args.output, args.n_grid, args.num_samples)
+
+if __name__ == "__main__":
+    main()
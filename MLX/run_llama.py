@@ -7,13 +7,16 @@ Runs LLaMA-2-13B in 4-bit quantization using Apple's MLX framework.
 import argparse
 import time
 import sys
+from multiprocessing import AuthenticationError
 from pathlib import Path
 
 try:
     import mlx.core as mx
     import mlx.nn as nn
-    from mlx_lm import load, generate
-    from mlx_lm.utils import generate_step
+    from mlx_lm import load
+    from mlx_lm.generate import generate_step
+    from model_server import positive_int, request_generation, resolve_model_path, DEFAULT_PORT
+    from sampling import make_top_k_sampler
 except ImportError as e:
     print(f"Error: Missing required dependencies")
     print(f"Import error: {e}")
@@ -21,9 +24,9 @@ except ImportError as e:
 
 def load_model(model_path: str = None):
     """Load the LLaMA-2-13B model with 4-bit quantization."""
-    if model_path is None:
-        # Default to a 4-bit quantized LLaMA-2-13B model
-        model_path = "TheBloke/Llama-2-13B-chat-AWQ"
+    # Default to the AWQ weights from prepare_awq.py if present, otherwise
+    # the MLX-native 4-bit conversion made by setup.sh
+    model_path = resolve_model_path(model_path)
     
     print(f"Loading model: {model_path}")
     
@@ -35,6 +38,7 @@ def load_model(model_path: str = None):
     except Exception as e:
         print(f"Error loading model: {e}")
         print("Make sure you have sufficient memory (32GB+ recommended)")
+        print("If the model hasn't been converted yet, run ./setup.sh first")
         sys.exit(1)
 
 def generate_text(model, tokenizer, prompt: str, max_tokens: int = 512, temperature: float = 0.7):
@@ -44,29 +48,40 @@ def generate_text(model, tokenizer, prompt: str, max_tokens: int = 512, temperat
     print(f"Max tokens: {max_tokens}, Temperature: {temperature}")
     print("-" * 50)
     
-    start_time = time.time()
-    
     try:
         # Tokenize the prompt
         inputs = tokenizer.encode(prompt)
+        sampler = make_top_k_sampler(temp=temperature, top_p=0.9, top_k=40)
         
-        # Generate response
-        response = generate(
-            model, 
-            tokenizer, 
-            prompt, 
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=0.9
-        )
+        # Stream tokens so prefill (time to first token) and decode can be timed separately
+        token_ids = []
+        start_time = time.perf_counter()
+        first_token_time = None
+        
+        for token, _ in generate_step(mx.array(inputs), model, max_tokens=max_tokens, sampler=sampler):
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+            if token in tokenizer.eos_token_ids:
+                break
+            token_ids.append(token)
+        
+        end_time = time.perf_counter()
+        if first_token_time is None:
+            print(f"No tokens generated (max_tokens={max_tokens})")
+            return None
+        
+        response = tokenizer.decode(token_ids)
+        tokens_generated = len(token_ids)
         
-        generation_time = time.time() - start_time
-        tokens_generated = len(tokenizer.encode(response)) - len(inputs)
+        prefill_time = first_token_time - start_time
+        decode_time = end_time - first_token_time
         
         print(f"Response:\n{response}")
         print("-" * 50)
-        print(f"Generated {tokens_generated} tokens in {generation_time:.2f}s")
-        print(f"Speed: {tokens_generated/generation_time:.1f} tokens/second")
+        print(f"Generated {tokens_generated} tokens in {end_time - start_time:.2f}s")
+        print(f"Prefill: {len(inputs)} tokens in {prefill_time:.2f}s ({len(inputs)/prefill_time:.1f} tokens/second)")
+        if tokens_generated > 1 and decode_time > 0:
+            print(f"Decode: {(tokens_generated - 1)/decode_time:.1f} tokens/second")
         
         return response
         
@@ -74,19 +89,57 @@ def generate_text(model, tokenizer, prompt: str, max_tokens: int = 512, temperat
         print(f"Error during generation: {e}")
         return None
 
+def generate_remote(prompt: str, max_tokens: int = 512, temperature: float = 0.7, port: int = DEFAULT_PORT):
+    """Generate text using an already-loaded model in a running model_server.py."""
+    print(f"\nGenerating response (model server on port {port})...")
+    print(f"Prompt: {prompt}")
+    print(f"Max tokens: {max_tokens}, Temperature: {temperature}")
+    print("-" * 50)
+    
+    start_time = time.time()
+    
+    try:
+        response, tokens_generated = request_generation(prompt, max_tokens, temperature, port=port)
+    except (ConnectionRefusedError, FileNotFoundError):
+        print("Could not reach the model server. Start it with: python model_server.py")
+        return None
+    except AuthenticationError:
+        print("The model server rejected our authkey (was it restarted with a different key?)")
+        return None
+    
+    if response is None:
+        print("Error during generation (see model server log)")
+        return None
+    
+    generation_time = time.time() - start_time
+    
+    print(f"Response:\n{response}")
+    print("-" * 50)
+    print(f"Generated {tokens_generated} tokens in {generation_time:.2f}s")
+    print(f"Speed: {tokens_generated/generation_time:.1f} tokens/second")
+    
+    return response
+
 def main():
     parser = argparse.ArgumentParser(description="Run LLaMA-2-13B with MLX")
     parser.add_argument("--prompt", type=str, default="Explain what machine learning is in simple terms", 
                        help="Input prompt for the model")
-    parser.add_argument("--max-tokens", type=int, default=512, 
+    parser.add_argument("--max-tokens", type=positive_int, default=512, 
                        help="Maximum number of tokens to generate")
     parser.add_argument("--temperature", type=float, default=0.7, 
                        help="Sampling temperature (0.0 = deterministic, 1.0 = random)")
     parser.add_argument("--model", type=str, 
-                       help="Custom model path (default: TheBloke/Llama-2-13B-chat-AWQ)")
+                       help="Custom model path (default: models/Llama-2-13b-chat-mlx-q4)")
+    parser.add_argument("--server", action="store_true", 
+                       help="Send the prompt to a running model_server.py instead of loading the model")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, 
+                       help="Model server port (used with --server)")
     
     args = parser.parse_args()
     
+    if args.server and args.model:
+        parser.error("--model cannot be used with --server; start model_server.py with --model instead")
+    
     print("MLX LLaMA-2-13B Runner")
     print("=" * 50)
     
@@ -98,17 +151,21 @@ def main():
     print(f"Default device: {mx.default_device()}")
     print()
     
-    # Load the model
-    model, tokenizer = load_model(args.model)
-    
-    # Generate text
-    response = generate_text(
-        model, 
-        tokenizer, 
-        args.prompt, 
-        args.max_tokens, 
-        args.temperature
-    )
+    if args.server:
+        # Reuse the model already resident in the server process
+        response = generate_remote(args.prompt, args.max_tokens, args.temperature, args.port)
+    else:
+        # Load the model
+        model, tokenizer = load_model(args.model)
+        
+        # Generate text
+        response = generate_text(
+            model, 
+            tokenizer, 
+            args.prompt, 
+            args.max_tokens, 
+            args.temperature
+        )
     
     if response:
         print("\nGeneration completed successfully!")
@@ -0,0 +1,33 @@
+"""
+Token Sampling for LLaMA-2-13B using MLX
+Top-k pre-filtered nucleus sampling shared by the runner, chat, server and benchmark.
+"""
+
+import mlx.core as mx
+
+def make_top_k_sampler(temp: float = 0.7, top_p: float = 0.9, top_k: int = 40):
+    """Build a sampler that keeps the top_k tokens before applying top-p.
+
+    Selecting the candidates with argpartition is linear in the vocabulary size,
+    so only top_k values are ever sorted instead of the full ~32k vocabulary.
+    """
+    if temp == 0:
+        return lambda logprobs: mx.argmax(logprobs, axis=-1)
+
+    def sampler(logprobs: mx.array) -> mx.array:
+        candidates = mx.argpartition(-logprobs, kth=top_k - 1, axis=-1)[..., :top_k]
+        candidate_logprobs = mx.take_along_axis(logprobs, candidates, axis=-1)
+
+        # Sort the few candidates and drop those outside the top-p mass
+        order = mx.argsort(-candidate_logprobs, axis=-1)
+        candidates = mx.take_along_axis(candidates, order, axis=-1)
+        candidate_logprobs = mx.take_along_axis(candidate_logprobs, order, axis=-1)
+
+        probs = mx.softmax(candidate_logprobs, axis=-1)
+        mass_before = mx.cumsum(probs, axis=-1) - probs
+        candidate_logprobs = mx.where(mass_before < top_p, candidate_logprobs, -float("inf"))
+
+        choice = mx.random.categorical(candidate_logprobs * (1.0 / temp), axis=-1)
+        return mx.take_along_axis(candidates, choice[..., None], axis=-1).squeeze(-1)
+
+    return sampler
@@ -5,6 +5,10 @@
 
 set -e
 
+# Work from the script's directory: the venv, requirements.txt and the
+# models/ directory the scripts load from all live here
+cd "$(dirname "$0")"
+
 # Check if we're on macOS
 if [[ "$OSTYPE" != "darwin"* ]]; then
     echo "This script is designed for macOS with Apple Silicon"
@@ -70,11 +74,35 @@ if mx.metal.is_available():
     print(f'Metal device: {mx.metal.get_device_name()}')
 "
 
+# Convert the model to MLX-native 4-bit weights
+MODEL_DIR="models/Llama-2-13b-chat-mlx-q4"
+if [ ! -d "$MODEL_DIR" ]; then
+    echo "Converting LLaMA-2-13B to MLX 4-bit (requires access to meta-llama/Llama-2-13b-chat-hf)..."
+    # Don't let a missing gated-repo login abort the rest of the setup
+    if python3 -m mlx_lm convert \
+        --hf-path meta-llama/Llama-2-13b-chat-hf \
+        --mlx-path "$MODEL_DIR" \
+        -q --q-bits 4 --q-group-size 64; then
+        echo "Model converted to $MODEL_DIR"
+    else
+        rm -rf "$MODEL_DIR"
+        echo "Model conversion failed."
+        echo "LLaMA-2 is a gated model: request access at https://huggingface.co/meta-llama/Llama-2-13b-chat-hf,"
+        echo "log in with 'huggingface-cli login', then rerun ./setup.sh or:"
+        echo "  python -m mlx_lm convert --hf-path meta-llama/Llama-2-13b-chat-hf \\"
+        echo "      --mlx-path $MODEL_DIR -q --q-bits 4 --q-group-size 64"
+    fi
+else
+    echo "Converted model already exists at $MODEL_DIR"
+fi
+
 # Make scripts executable
 echo "Making scripts executable..."
 chmod +x run_llama.py
 chmod +x chat_llama.py
 chmod +x benchmark.py
+chmod +x model_server.py
+chmod +x prepare_awq.py
 
 echo ""
 echo "Setup completed successfully!"
@@ -85,6 +113,6 @@ echo "2. Run a quick test: python run_llama.py"
 echo "3. Start interactive chat: python chat_llama.py"
 echo "4. Run benchmarks: python benchmark.py"
 echo ""
-echo "Note: The first run will download the LLaMA-2-13B model (~7.5GB)"
-echo "This may take several minutes depending on your internet connection."
+echo "Note: The conversion downloads the full LLaMA-2-13B weights (~26GB) once"
+echo "and writes a ~7.5GB 4-bit MLX model to $MODEL_DIR."
 echo ""
\ No newline at end of file